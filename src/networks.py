@@ -11,20 +11,67 @@ import math
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# Allow TF32 matmuls/convolutions and let scaled_dot_product_attention dispatch to the FlashAttention kernel where
+# available
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+if hasattr(torch.backends.cuda, 'enable_flash_sdp'):
+    torch.backends.cuda.enable_flash_sdp(True)
+
+
+def maybe_compile(fn, **kwargs):
+    """
+    This method wraps a module or function with torch.compile when it is available (torch >= 2.0).
+    :param fn: The module or function to be compiled.
+    :param kwargs: Keyword arguments passed on to torch.compile.
+    :return: The compiled module or function, or the unchanged one on older torch versions.
+    """
+    if hasattr(torch, 'compile'):
+        return torch.compile(fn, **kwargs)
+    return fn
+
+
+def fuse_for_inference(model: nn.Module) -> nn.Module:
+    """
+    This method folds every BatchNorm2d that directly follows a Conv2d inside an nn.Sequential into the weights and
+    bias of that convolution and replaces the BatchNorm2d with nn.Identity. Only valid in eval mode, as the running
+    statistics of the BatchNorm2d are baked in.
+    :param model: The model in eval mode whose convolutions are fused in place.
+    :return: The fused model.
+    """
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if not (isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d)):
+                continue
+            with torch.no_grad():
+                scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+                bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+                conv.weight.mul_(scale.view(-1, 1, 1, 1))
+                conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias)
+            module[i + 1] = nn.Identity()
+    return model
+
 
 class SimplePositionalEncoding(nn.Module):
     def __init__(self, num_channels, input_embedding_size):
         super(SimplePositionalEncoding, self).__init__()
-        self.pos_encoding = torch.zeros(num_channels, input_embedding_size)
         position = torch.arange(0, num_channels, dtype=torch.float).unsqueeze(1)
-        div_term = torch.exp(torch.arange(0, input_embedding_size, 2).float() * (
-                -torch.log(torch.tensor(10000.0)) / input_embedding_size))
-        self.pos_encoding[:, 0::2] = torch.sin(position * div_term)
-        self.pos_encoding[:, 1::2] = torch.cos(position * div_term)
-        self.pos_encoding = self.pos_encoding.unsqueeze(0)
+        div_term = torch.exp(torch.arange(0, input_embedding_size, 2, dtype=torch.float) * (
+                -math.log(10000.0) / input_embedding_size))
+        # Interleave sin and cos in one contiguous write instead of two strided assignments
+        pos_encoding = torch.stack([torch.sin(position * div_term), torch.cos(position * div_term)], dim=-1).flatten(-2)
+        # Registered as a buffer so that model.to(device) moves it once instead of on every forward
+        self.register_buffer('pos_encoding', pos_encoding.unsqueeze(0), persistent=False)
 
     def forward(self, x):
-        return x + self.pos_encoding[:, :x.size(1)].to(x.device)
+        pos_encoding = self.pos_encoding if x.size(1) == self.pos_encoding.size(1) else self.pos_encoding[:, :x.size(1)]
+        # Add in place when autograd does not need x, saving a temporary per forward
+        if x.requires_grad:
+            return x + pos_encoding
+        return x.add_(pos_encoding)
 
 
 class LearnedPositionalEncoding(nn.Module):
@@ -44,22 +91,53 @@ class LearnedPositionalEncoding(nn.Module):
 class TransformerBlock(nn.Module):
     def __init__(self, input_embedding_size, num_heads, hidden_size, dropout):
         super(TransformerBlock, self).__init__()
-        self.self_attn = nn.MultiheadAttention(embed_dim=input_embedding_size, num_heads=num_heads, batch_first=True)
+        self.num_heads = num_heads
+        self.qkv_projection = nn.Linear(in_features=input_embedding_size, out_features=3 * input_embedding_size)
+        self.out_projection = nn.Linear(in_features=input_embedding_size, out_features=input_embedding_size)
         self.norm1 = nn.LayerNorm(input_embedding_size)
         self.linear1 = nn.Linear(in_features=input_embedding_size, out_features=hidden_size)
         self.relu1 = nn.ReLU()
         self.linear2 = nn.Linear(in_features=hidden_size, out_features=input_embedding_size)
         self.norm2 = nn.LayerNorm(input_embedding_size)
         self.dropout = nn.Dropout(p=dropout)
+        self._reset_attn_parameters()
+
+    # Keys of the nn.MultiheadAttention this block used before, mapped to the fused projections replacing it. The
+    # stacked [q; k; v] rows of in_proj_weight match the layout of qkv_projection, so old checkpoints load unchanged.
+    _legacy_attn_keys = {
+        'self_attn.in_proj_weight': 'qkv_projection.weight',
+        'self_attn.in_proj_bias': 'qkv_projection.bias',
+        'self_attn.out_proj.weight': 'out_projection.weight',
+        'self_attn.out_proj.bias': 'out_projection.bias',
+    }
+
+    def _reset_attn_parameters(self):
+        # Same initialisation as nn.MultiheadAttention, so training dynamics match the previous implementation
+        nn.init.xavier_uniform_(self.qkv_projection.weight)
+        nn.init.zeros_(self.qkv_projection.bias)
+        nn.init.zeros_(self.out_projection.bias)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for legacy_key, key in self._legacy_attn_keys.items():
+            if prefix + legacy_key in state_dict:
+                state_dict[prefix + key] = state_dict.pop(prefix + legacy_key)
+        super(TransformerBlock, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def self_attn(self, x):
+        queries, keys, values = rearrange(self.qkv_projection(x), "b n (qkv h d) -> qkv b h n d",
+                                          qkv=3, h=self.num_heads)
+        if hasattr(F, 'scaled_dot_product_attention'):
+            # Fused kernel (FlashAttention / memory efficient) on torch >= 2.0
+            out = F.scaled_dot_product_attention(queries, keys, values, is_causal=False)
+        else:
+            energy = torch.einsum('bhqd, bhkd -> bhqk', queries, keys) / math.sqrt(queries.size(-1))
+            out = torch.einsum('bhqk, bhkd -> bhqd', F.softmax(energy, dim=-1), values)
+        out = rearrange(out, "b h n d -> b n (h d)")
+        return self.out_projection(out)
 
     def forward(self, x):
-        attn_output, _ = self.self_attn(x, x, x)
-        x = self.norm1(x + self.dropout(attn_output))
-        ff_output = self.linear1(x)
-        ff_output = self.relu1(ff_output)
-        ff_output = self.linear2(ff_output)
-        x = x + self.dropout(ff_output)
-        x = self.norm2(x)
+        x = self.norm1(x + self.dropout(self.self_attn(x)))
+        x = self.norm2(x + self.dropout(self.linear2(self.relu1(self.linear1(x)))))
         return x
 
 
@@ -76,11 +154,12 @@ class ConvBlock(nn.Module):
             nn.AvgPool2d(kernel_size=(1, 30), stride=(1, 15)),
             nn.Dropout(p=dropout),
             nn.Conv2d(in_channels=40, out_channels=input_embedding_size, kernel_size=(1, 1), stride=(1, 1)),
-            nn.Flatten(start_dim=2)
-        )
+            # Emit (batch, tokens, embedding) directly, a contiguous view of the channels_last feature map
+            Rearrange('b e (h) (w) -> b (h w) e')
+        ).to(memory_format=torch.channels_last)
 
     def forward(self, x):
-        return self.conv_block(x)
+        return self.conv_block(x.contiguous(memory_format=torch.channels_last))
 
 
 class ShallProjBlock(nn.Module):
@@ -94,7 +173,7 @@ class ShallProjBlock(nn.Module):
             nn.SiLU(),
             nn.AvgPool2d(kernel_size=(1, 3), stride=(1, 15)),
             nn.Dropout(dropout),
-        )
+        ).to(memory_format=torch.channels_last)
 
         self.projection_net = nn.Sequential(
             nn.Conv2d(in_channels=40, out_channels=input_embedding_size, kernel_size=(1, 1), stride=(1, 1)),
@@ -102,8 +181,9 @@ class ShallProjBlock(nn.Module):
         )
 
     def forward(self, x):
-        x = self.shallow_net(x)
-        x = self.projection_net(x)
+        x = self.shallow_net(x.contiguous(memory_format=torch.channels_last))
+        # Back to contiguous NCHW, so the flattened (B, E, W) output fed to the encoder is contiguous
+        x = self.projection_net(x.contiguous())
         return x
 
 
@@ -123,15 +203,18 @@ class EEGTransformerBasic(nn.Module):
         self.do_positional_encoding = do_positional_encoding
         self.learned_positional_encoding = learned_positional_encoding
         self.input_embedding = nn.Linear(in_features=window_size, out_features=input_embedding_size)
+        # Only the positional encoding used in forward is built, so no unused parameters end up in the state_dict
         self.simple_pos_encoding = SimplePositionalEncoding(num_channels=num_channels,
-                                                            input_embedding_size=input_embedding_size)
+                                                            input_embedding_size=input_embedding_size) \
+            if do_positional_encoding and not learned_positional_encoding else None
         self.learned_pos_encoding = LearnedPositionalEncoding(num_channels=num_channels,
-                                                              input_embedding_size=input_embedding_size)
-        self.encoder = nn.ModuleList(
-            [TransformerBlock(input_embedding_size=input_embedding_size,
-                              num_heads=num_heads,
-                              hidden_size=hidden_size,
-                              dropout=dropout) for _ in range(num_layers)])
+                                                              input_embedding_size=input_embedding_size) \
+            if do_positional_encoding and learned_positional_encoding else None
+        self.encoder = nn.Sequential(
+            *[TransformerBlock(input_embedding_size=input_embedding_size,
+                               num_heads=num_heads,
+                               hidden_size=hidden_size,
+                               dropout=dropout) for _ in range(num_layers)])
         self.ff = nn.Sequential(
             nn.Linear(in_features=input_embedding_size, out_features=512),
             nn.SiLU(),
@@ -149,8 +232,7 @@ class EEGTransformerBasic(nn.Module):
                 x = self.learned_pos_encoding(x)
             else:
                 x = self.simple_pos_encoding(x)
-        for layer in self.encoder:
-            x = layer(x)
+        x = self.encoder(x)
         x = torch.mean(input=x, dim=1)
         x = self.ff(x)
         return x
@@ -172,15 +254,18 @@ class EEGTransformerInverse(nn.Module):
         self.do_positional_encoding = do_positional_encoding
         self.learned_positional_encoding = learned_positional_encoding
         self.input_embedding = nn.Linear(in_features=num_channels, out_features=input_embedding_size)
+        # Only the positional encoding used in forward is built, so no unused parameters end up in the state_dict
         self.simple_pos_encoding = SimplePositionalEncoding(num_channels=window_size,
-                                                            input_embedding_size=input_embedding_size)
+                                                            input_embedding_size=input_embedding_size) \
+            if do_positional_encoding and not learned_positional_encoding else None
         self.learned_pos_encoding = LearnedPositionalEncoding(num_channels=window_size,
-                                                              input_embedding_size=input_embedding_size)
-        self.encoder = nn.ModuleList(
-            [TransformerBlock(input_embedding_size=input_embedding_size,
-                              num_heads=num_heads,
-                              hidden_size=hidden_size,
-                              dropout=dropout) for _ in range(num_layers)])
+                                                              input_embedding_size=input_embedding_size) \
+            if do_positional_encoding and learned_positional_encoding else None
+        self.encoder = nn.Sequential(
+            *[TransformerBlock(input_embedding_size=input_embedding_size,
+                               num_heads=num_heads,
+                               hidden_size=hidden_size,
+                               dropout=dropout) for _ in range(num_layers)])
         self.ff = nn.Sequential(
             nn.Linear(in_features=input_embedding_size, out_features=512),
             nn.SiLU(),
@@ -191,9 +276,6 @@ class EEGTransformerInverse(nn.Module):
             nn.Linear(in_features=128, out_features=num_classes)
         )
 
-        # for param in self.input_embedding.parameters():
-        #     param.requires_grad = False
-
     def forward(self, x):
         x = torch.transpose(input=x, dim0=1, dim1=2)
         x = self.input_embedding(x)
@@ -202,8 +284,7 @@ class EEGTransformerInverse(nn.Module):
                 x = self.learned_pos_encoding(x)
             else:
                 x = self.simple_pos_encoding(x)
-        for layer in self.encoder:
-            x = layer(x)
+        x = self.encoder(x)
         x = x.mean(dim=1)
         x = self.ff(x)
         return x
@@ -223,11 +304,11 @@ class EEGTransformerConv(nn.Module):
                  num_classes):
         super(EEGTransformerConv, self).__init__()
         self.conv_net = ConvBlock(input_embedding_size, dropout)
-        self.encoder = nn.ModuleList(
-            [TransformerBlock(input_embedding_size=input_embedding_size,
-                              num_heads=num_heads,
-                              hidden_size=hidden_size,
-                              dropout=dropout) for _ in range(num_layers)])
+        self.encoder = nn.Sequential(
+            *[TransformerBlock(input_embedding_size=input_embedding_size,
+                               num_heads=num_heads,
+                               hidden_size=hidden_size,
+                               dropout=dropout) for _ in range(num_layers)])
         self.fc = nn.Sequential(
             nn.LayerNorm(normalized_shape=input_embedding_size),
             nn.Linear(in_features=input_embedding_size, out_features=num_classes),
@@ -236,9 +317,7 @@ class EEGTransformerConv(nn.Module):
     def forward(self, x):
         x = x.unsqueeze(dim=1)
         x = self.conv_net(x)
-        x = torch.transpose(input=x, dim0=1, dim1=2)
-        for layer in self.encoder:
-            x = layer(x)
+        x = self.encoder(x)
         x = torch.mean(input=x, dim=1)
         x = self.fc(x)
         return x
@@ -258,11 +337,11 @@ class EEGTransformerConvFFT(nn.Module):
                  num_classes):
         super(EEGTransformerConvFFT, self).__init__()
         self.conv_net = ConvBlock(input_embedding_size, dropout)
-        self.encoder = nn.ModuleList(
-            [TransformerBlock(input_embedding_size=input_embedding_size,
-                              num_heads=num_heads,
-                              hidden_size=hidden_size,
-                              dropout=dropout) for _ in range(num_layers)])
+        self.encoder = nn.Sequential(
+            *[TransformerBlock(input_embedding_size=input_embedding_size,
+                               num_heads=num_heads,
+                               hidden_size=hidden_size,
+                               dropout=dropout) for _ in range(num_layers)])
         self.fc = nn.Sequential(
             nn.LayerNorm(normalized_shape=input_embedding_size),
             nn.Linear(in_features=input_embedding_size, out_features=num_classes),
@@ -272,9 +351,7 @@ class EEGTransformerConvFFT(nn.Module):
         x = (torch.fft.fft(x, dim=-1)).to(device=x.device, dtype=torch.float)
         x = x.unsqueeze(dim=1)
         x = self.conv_net(x)
-        x = torch.transpose(input=x, dim0=1, dim1=2)
-        for layer in self.encoder:
-            x = layer(x)
+        x = self.encoder(x)
         x = torch.mean(input=x, dim=1)
         x = self.fc(x)
         return x
@@ -294,11 +371,11 @@ class EEGTransformerMaster(nn.Module):
                  num_classes):
         super(EEGTransformerMaster, self).__init__()
         self.shallow_projection_net = ShallProjBlock(input_embedding_size, dropout)
-        self.encoder = nn.ModuleList(
-            [TransformerBlock(input_embedding_size=1104,
-                              num_heads=num_heads,
-                              hidden_size=hidden_size,
-                              dropout=dropout) for _ in range(num_layers)])
+        self.encoder = nn.Sequential(
+            *[TransformerBlock(input_embedding_size=1104,
+                               num_heads=num_heads,
+                               hidden_size=hidden_size,
+                               dropout=dropout) for _ in range(num_layers)])
         self.fc = nn.Sequential(
             nn.LayerNorm(normalized_shape=1104),
             nn.Linear(in_features=1104, out_features=2440),
@@ -316,8 +393,7 @@ class EEGTransformerMaster(nn.Module):
         x = torch.transpose(input=x, dim0=1, dim1=2)
         x = x.unsqueeze(dim=1)
         x = self.shallow_projection_net(x)
-        for layer in self.encoder:
-            x = layer(x)
+        x = self.encoder(x)
         x = torch.mean(input=x, dim=1)
         x = self.fc(x)
         return x
@@ -335,18 +411,18 @@ class PatchEmbedding(nn.Module):
             nn.ELU(),
             nn.AvgPool2d((1, 75), (1, 15)),  # pooling acts as slicing to obtain 'patch' along the time dimension as in ViT
             nn.Dropout(0.5),
-        )
+        ).to(memory_format=torch.channels_last)
 
         self.projection = nn.Sequential(
             nn.Conv2d(40, emb_size, (1, 1), stride=(1, 1)),  # transpose, conv could enhance fiting ability slightly
             Rearrange('b e (h) (w) -> b (h w) e'),
-        )
+        ).to(memory_format=torch.channels_last)
 
 
     def forward(self, x: Tensor) -> Tensor:
         # x = torch.transpose(input=x, dim0=2, dim1=3)
         b, _, _, _ = x.shape
-        x = self.shallownet(x)
+        x = self.shallownet(x.contiguous(memory_format=torch.channels_last))
         x = self.projection(x)
         return x
 
@@ -1,4 +1,5 @@
 import os
+import copy
 import argparse
 import logging
 import time
@@ -95,6 +96,8 @@ def train(exp_name: str,
 
     # Device configuration
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # Run the forward passes in bfloat16 where the GPU supports it, halving activation memory traffic
+    use_bf16 = device.type == 'cuda' and torch.cuda.is_bf16_supported()
 
     # Load the dataset and preprocess it and get the train, validation and test sets
     full_train_set, \
@@ -111,20 +114,33 @@ def train(exp_name: str,
                                            training_set_size=training_set_size)
 
     # Instantiating the Train, Validation and Test DataLoaders
+    # Batches are loaded by persistent worker processes into pinned memory, so host to device copies can be async
+    num_workers = (os.cpu_count() or 1) // 2
+    loader_kwargs = {
+        'num_workers': num_workers,
+        'pin_memory': torch.cuda.is_available(),
+        'persistent_workers': num_workers > 0
+    }
+    if num_workers > 0:
+        loader_kwargs['prefetch_factor'] = 4
     if use_full_data:
         train_loader = DataLoader(dataset=full_train_set,
                                   batch_size=batch_size,
-                                  shuffle=True)
+                                  shuffle=True,
+                                  **loader_kwargs)
     else:
         train_loader = DataLoader(dataset=train_set,
                                   batch_size=batch_size,
-                                  shuffle=True)
+                                  shuffle=True,
+                                  **loader_kwargs)
     val_loader = DataLoader(dataset=valid_set,
                             batch_size=batch_size,
-                            shuffle=False)
+                            shuffle=False,
+                            **loader_kwargs)
     test_loader = DataLoader(dataset=eval_set,
                              batch_size=batch_size,
-                             shuffle=False)
+                             shuffle=False,
+                             **loader_kwargs)
 
     num_channels = full_train_set[0][0].shape[0]
     window_size = full_train_set[0][0].shape[1]
@@ -153,6 +169,12 @@ def train(exp_name: str,
             num_classes=num_classes
         ).to(device)
 
+    # Compile the model for training and validation on torch >= 2.0. max-autotune fuses the memory bound convolutional
+    # tails (AvgPool2d -> Dropout -> 1x1 Conv2d) with autotuned kernels and captures the forward pass with CUDA graphs.
+    # The input shape is fixed, so the graphs are specialized to static shapes. The uncompiled model is kept for the
+    # optimizer, inference fusion and saving the state_dict.
+    compiled_model = maybe_compile(model, mode='max-autotune', fullgraph=False, dynamic=False)
+
     # Instantiating training criterion
     criterion = train_criterion().to(device)
     avg_train_loss = []
@@ -226,12 +248,13 @@ def train(exp_name: str,
 
         # Loop through the batches
         for i, data in enumerate(train_loader):
-            signals = data[0].to(device)
-            labels = data[1].to(device)
+            signals = data[0].to(device, non_blocking=True)
+            labels = data[1].to(device, non_blocking=True)
             signals = signals.unsqueeze(1)
             optimizer.zero_grad()
-            logits = model(signals)
-            loss = criterion(logits, labels)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                logits = compiled_model(signals)
+                loss = criterion(logits, labels)
             loss.backward()
             optimizer.step()
             if scheduler is not None:
@@ -253,11 +276,12 @@ def train(exp_name: str,
         avg_train_acc.append(train_avg_acc)
 
         for i, data in enumerate(val_loader):
-            signals = data[0].to(device)
-            labels = data[1].to(device)
+            signals = data[0].to(device, non_blocking=True)
+            labels = data[1].to(device, non_blocking=True)
             signals = signals.unsqueeze(1)
-            logits = model(signals)
-            loss = criterion(logits, labels)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                logits = compiled_model(signals)
+                loss = criterion(logits, labels)
             preds = torch.argmax(logits, dim=1)
             acc = torch.sum(preds == labels) / len(labels)
 
@@ -280,7 +304,9 @@ def train(exp_name: str,
     print(f'Overall Training Time: {time_train_full / 60:.2f} Minutes')
     print(f'Average Training Time / Epoch: {time_train_full / (60 * num_epochs):.2f} Minutes')
 
-    # Generate predictions for test set
+    # Generate predictions for test set on an eval mode copy with BatchNorm folded into the preceding convolutions,
+    # so that the stored model keeps its original state_dict layout
+    inference_model = fuse_for_inference(copy.deepcopy(model).eval())
     predictions = np.array([])
     eval_sum_loss = 0.0
     eval_avg_loss = 0.0
@@ -289,13 +315,14 @@ def train(exp_name: str,
     eval_avg_acc = 0.0
     eval_cnt_acc = 0
     for i, data in enumerate(test_loader):
-        signals = data[0].to(device)
-        labels = data[1].to(device)
+        signals = data[0].to(device, non_blocking=True)
+        labels = data[1].to(device, non_blocking=True)
         signals = signals.unsqueeze(1)
-        logits = model(signals)
+        with torch.no_grad(), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+            logits = inference_model(signals)
+            loss = criterion(logits, labels)
         preds = torch.argmax(logits, dim=1)
         predictions = np.append(predictions, preds.cpu().detach().numpy())
-        loss = criterion(logits, labels)
         preds = torch.argmax(logits, dim=1)
         acc = torch.sum(preds == labels) / len(labels)
 
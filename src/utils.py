@@ -1,22 +1,67 @@
 import os
 import numpy as np
 import pandas as pd
+from scipy.signal import lfilter
 import matplotlib.pyplot as plt
 import seaborn as sns
 from typing import List, Tuple, Any
 
-from braindecode.datasets import MOABBDataset, WindowsDataset
+from braindecode.datasets import MOABBDataset, WindowsDataset, BaseConcatDataset
 from braindecode.datautil import load_concat_dataset
-from braindecode.preprocessing import exponential_moving_standardize, create_windows_from_events, \
-    preprocess, Preprocessor
+from braindecode.preprocessing import create_windows_from_events, preprocess, Preprocessor
 
 import torch
 from torch.utils.data import Subset
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
+class CachedWindowsDataset(WindowsDataset):
+    """
+    WindowsDataset whose windows are read from a float32 array cached once at construction, instead of being rebuilt
+    from the MNE Epochs on every access. The preloaded Epochs data is kept alongside the cache, as the Epochs still
+    back the metadata, so the windows take roughly 1.5x the memory of the Epochs alone.
+    """
+
+    def __init__(self, windows, description=None, transform=None, targets_from='metadata', last_target_only=True):
+        # Targets read from misc channels would have to be split off the cached windows, which is not supported
+        if targets_from != 'metadata':
+            raise ValueError(f"CachedWindowsDataset only supports targets_from='metadata', got '{targets_from}'")
+        super(CachedWindowsDataset, self).__init__(windows=windows,
+                                                   description=description,
+                                                   transform=transform,
+                                                   targets_from=targets_from,
+                                                   last_target_only=last_target_only)
+        self._data = np.ascontiguousarray(windows.get_data(), dtype=np.float32)
+
+    @classmethod
+    def from_windows_dataset(cls, windows_dataset: WindowsDataset) -> 'CachedWindowsDataset':
+        """
+        This method creates a cached copy of an existing WindowsDataset, sharing its Epochs.
+        :param windows_dataset: The WindowsDataset to cache.
+        :return: The CachedWindowsDataset.
+        """
+        return cls(windows=windows_dataset.windows,
+                   description=windows_dataset.description,
+                   transform=windows_dataset.transform,
+                   targets_from=windows_dataset.targets_from,
+                   last_target_only=windows_dataset.last_target_only)
+
+    def __getitem__(self, index):
+        X = self._data[index]
+        if self.transform is not None:
+            X = self.transform(X)
+        y = self.y[index]
+        crop_inds = self.crop_inds[index].tolist()
+        return X, y, crop_inds
+
+
 def create_directory(folder_name: str) -> None:
     """
     This method creates a directory with desired name.
@@ -80,6 +125,45 @@ def fetch_and_store(dataset_name: str, subject_ids: str, data_folder_name: str)
     return fetched_dataset
 
 
+def _volts_to_micro_volts(data: np.ndarray) -> np.ndarray:
+    """
+    This method converts an EEG signal from Volts to MicroVolts, scaling it in place to avoid allocating a copy. It is
+    defined at module level so that parallel preprocessing jobs only pickle a reference to it.
+    :param data: The signal which needs conversion from Volts to MicroVolts.
+    :return: The converted signal in MicroVolts.
+    """
+    data *= 1e6
+    return data
+
+
+def _ems_lfilter(data: np.ndarray,
+                 factor_new: float = 1e-3,
+                 init_block_size: int = None,
+                 eps: float = 1e-4) -> np.ndarray:
+    """
+    This method applies exponential moving standardization using scipy.signal.lfilter, giving the same result as
+    braindecode's pandas ewm based exponential_moving_standardize without its DataFrame round trips.
+    :param data: The signal of shape (n_channels, n_times), time being the last axis.
+    :param factor_new: The weight given to the newest sample in the exponential moving mean and variance.
+    :param init_block_size: The number of initial samples standardized with their plain mean and standard deviation.
+    :param eps: Lower bound of the standard deviation to avoid division by zero.
+    :return: The standardized signal of shape (n_channels, n_times).
+    """
+    b, a = [1.0], [1.0, -(1.0 - factor_new)]
+    # pandas' ewm(adjust=True) normalises by the accumulated weights, which is the same filter applied to ones
+    weights = lfilter(b, a, np.ones(data.shape[-1]))
+    meaned = lfilter(b, a, data, axis=-1) / weights
+    demeaned = data - meaned
+    square_ewmed = lfilter(b, a, demeaned * demeaned, axis=-1) / weights
+    standardized = demeaned / np.maximum(eps, np.sqrt(square_ewmed))
+    if init_block_size is not None:
+        init_block = data[..., :init_block_size]
+        init_mean = np.mean(init_block, axis=-1, keepdims=True)
+        init_std = np.std(init_block, axis=-1, keepdims=True)
+        standardized[..., :init_block_size] = (init_block - init_mean) / np.maximum(eps, init_std)
+    return standardized
+
+
 def conversions_and_filtering(data: MOABBDataset,
                               l_freq: float = 4.0,
                               h_freq: float = 38.0,
@@ -96,14 +180,6 @@ def conversions_and_filtering(data: MOABBDataset,
     :return: The dataset on which all the conversions and filtering has been applied.
     """
 
-    def convert_from_volts_to_micro_volts(dataset: MOABBDataset = data) -> None:
-        """
-        This method converts an EEG Dataset from Volts to MicroVolts.
-        :param dataset: The dataset which needs conversion from Volts to MicroVolts.
-        :return: The converted dataset from Volts to MicroVolts.
-        """
-        return np.multiply(dataset, 1e6)
-
     # The following preprocessing is applied to the dataset,
     # 1. Keeps only the EEG Channel and drops MEG and STIM Channels.
     # 2. Converts the signals from Volts to MicroVolts. Hence, multiplies the received signal with a factor of 1e6.
@@ -111,11 +187,13 @@ def conversions_and_filtering(data: MOABBDataset,
     # 4. Apply exponential_moving_standardize with a factor of 1e-3 and init_block_size of 1000.
     preprocessors = [
         Preprocessor('pick_types', eeg=True, meg=False, stim=False),
-        Preprocessor(convert_from_volts_to_micro_volts),
-        Preprocessor('filter', l_freq=l_freq, h_freq=h_freq),
-        Preprocessor(exponential_moving_standardize, factor_new=ems_factor, init_block_size=init_block_size)
+        Preprocessor(_volts_to_micro_volts),
+        Preprocessor('filter', l_freq=l_freq, h_freq=h_freq, n_jobs=1),
+        Preprocessor(_ems_lfilter, factor_new=ems_factor, init_block_size=init_block_size)
     ]
-    preprocess(data, preprocessors)
+    # Preprocess the recordings in parallel, one job per core; MNE filtering is kept single threaded (n_jobs=1 above) to
+    # avoid oversubscribing the cores
+    preprocess(data, preprocessors, n_jobs=-1)
     return data
 
 
@@ -137,6 +215,10 @@ def cut_dataset_windows(data: MOABBDataset,
                                       window_stride_samples=None,
                                       drop_last_window=False,
                                       preload=True)
+
+    # Cache the windows of each recording as a contiguous float32 array to skip the MNE overhead on every access
+    data = BaseConcatDataset([CachedWindowsDataset.from_windows_dataset(windows_dataset)
+                              for windows_dataset in data.datasets])
     return data
 
 
@@ -204,7 +286,7 @@ def split_dataset(data: WindowsDataset, training_set_size: float = 0.8) -> Tuple
     full_train_set = split_data['session_T']  # Training + Validation dataset
     split_index = int(len(full_train_set) * training_set_size)  # Index at which Training and Validation data is split
     train_set = Subset(full_train_set, range(0, split_index))  # Training dataset
-    valid_set = Subset(full_train_set, range(split_index, 2592))  # Validation dataset
+    valid_set = Subset(full_train_set, range(split_index, len(full_train_set)))  # Validation dataset
     eval_set = split_data['session_E']  # Evaluation dataset
 
     return full_train_set, train_set, valid_set, eval_set
@@ -257,31 +339,134 @@ def get_data_and_preprocess(dataset_dir: str,
     return full_train_set, train_set, valid_set, eval_set
 
 
-def interaug(timg, label, batch_size):
-    aug_data = []
-    aug_label = []
+NUM_SEGMENTS = 8
+SEGMENT_SIZE = 125
+
+
+def _interaug_numpy(timg: np.ndarray,
+                    label: np.ndarray,
+                    out_data: np.ndarray,
+                    out_label: np.ndarray,
+                    batch_size: int) -> None:
+    """
+    This method fills the preallocated augmentation buffers using vectorized NumPy gathers.
+    :param timg: The trials to augment, of shape (num_trials, 1, 22, 1125).
+    :param label: The class labels of the trials.
+    :param out_data: The zero initialised buffer of shape (batch_size, 1, 22, 1125) receiving the augmented trials.
+    :param out_label: The buffer of shape (batch_size,) receiving the augmented labels.
+    :param batch_size: The number of augmented trials to generate, split equally among the 4 classes.
+    :return: None.
+    """
+    aug_size = batch_size // 4
+    # Bucket the trials by class with a single sort instead of one full scan of label per class
+    order = np.argsort(label, kind='stable')
+    bounds = np.searchsorted(label[order], np.arange(5))
     for cls4aug in range(4):
-        cls_idx = np.where(label == cls4aug)
+        cls_idx = order[bounds[cls4aug]:bounds[cls4aug + 1]]
         tmp_data = timg[cls_idx]
-        tmp_label = label[cls_idx]
-
-        tmp_aug_data = np.zeros((int(batch_size / 4), 1, 22, 1125))
-        for ri in range(int(batch_size / 4)):
-            for rj in range(8):
-                rand_idx = np.random.randint(0, tmp_data.shape[0], 8)
-                tmp_aug_data[ri, :, :, rj * 125:(rj + 1) * 125] = tmp_data[rand_idx[rj], :, :,
-                                                                  rj * 125:(rj + 1) * 125]
-
-        aug_data.append(tmp_aug_data)
-        aug_label.append(tmp_label)#[:int(batch_size / 4)])
-    aug_data = np.concatenate(aug_data)
-    aug_label = np.concatenate(aug_label)
+
+        # View the trials as (num_trials, 1, 22, NUM_SEGMENTS, SEGMENT_SIZE) and gather all segments in one shot
+        segments = tmp_data[..., :NUM_SEGMENTS * SEGMENT_SIZE].reshape(
+            tmp_data.shape[0], 1, 22, NUM_SEGMENTS, SEGMENT_SIZE)
+        rand_idx = np.random.randint(0, tmp_data.shape[0], size=(aug_size, NUM_SEGMENTS))
+        gathered = segments[rand_idx, :, :, np.arange(NUM_SEGMENTS)[None, :], :]  # (aug_size, 8, 1, 22, 125)
+
+        out_data[cls4aug * aug_size:(cls4aug + 1) * aug_size, ..., :NUM_SEGMENTS * SEGMENT_SIZE] = \
+            gathered.transpose(0, 2, 3, 1, 4).reshape(aug_size, 1, 22, NUM_SEGMENTS * SEGMENT_SIZE)
+        out_label[cls4aug * aug_size:(cls4aug + 1) * aug_size] = cls4aug
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _interaug_core(timg, label, out_data, out_label, batch_size):
+        """
+        This method fills the preallocated augmentation buffers with a compiled, multithreaded Numba kernel. Every
+        class must be present in label, which interaug checks before calling it.
+        :param timg: The trials to augment, of shape (num_trials, 1, 22, 1125).
+        :param label: The class labels of the trials.
+        :param out_data: The zero initialised buffer of shape (batch_size, 1, 22, 1125) receiving the augmented trials.
+        :param out_label: The buffer of shape (batch_size,) receiving the augmented labels.
+        :param batch_size: The number of augmented trials to generate, split equally among the 4 classes.
+        :return: None.
+        """
+        aug_size = batch_size // 4
+        order = np.argsort(label, kind='mergesort')
+        bounds = np.searchsorted(label[order], np.arange(5))
+        for cls4aug in range(4):
+            cls_idx = order[bounds[cls4aug]:bounds[cls4aug + 1]]
+            for ri in numba.prange(aug_size):
+                row = cls4aug * aug_size + ri
+                for rj in range(NUM_SEGMENTS):
+                    src = cls_idx[np.random.randint(0, cls_idx.shape[0])]
+                    for ch in range(timg.shape[2]):
+                        for t in range(rj * SEGMENT_SIZE, (rj + 1) * SEGMENT_SIZE):
+                            out_data[row, 0, ch, t] = timg[src, 0, ch, t]
+                out_label[row] = cls4aug
+else:
+    _interaug_core = _interaug_numpy
+
+
+def _interaug_torch(timg: torch.Tensor, label: torch.Tensor, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    This method generates the augmented trials directly on the device of the given tensors, so that no float64
+    intermediate and no host to device copy is needed.
+    :param timg: The float32 trials to augment, of shape (num_trials, 1, 22, 1125).
+    :param label: The class labels of the trials, on the same device as timg.
+    :param batch_size: The number of augmented trials to generate, split equally among the 4 classes.
+    :return: The augmented trials and their labels.
+    """
+    aug_size = batch_size // 4
+    aug_data = torch.empty((4 * aug_size, 1, 22, 1125), device=timg.device, dtype=torch.float32)
+    aug_data[..., NUM_SEGMENTS * SEGMENT_SIZE:] = 0
+    aug_label = torch.empty(4 * aug_size, device=timg.device, dtype=torch.long)
+    sorted_label, order = torch.sort(label, stable=True)
+    bounds = torch.searchsorted(sorted_label, torch.arange(5, device=label.device, dtype=label.dtype)).tolist()
+    for cls4aug in range(4):
+        cls_idx = order[bounds[cls4aug]:bounds[cls4aug + 1]]
+        rand_idx = cls_idx[torch.randint(0, cls_idx.shape[0], (aug_size, NUM_SEGMENTS), device=timg.device)]
+        rows = slice(cls4aug * aug_size, (cls4aug + 1) * aug_size)
+        for rj in range(NUM_SEGMENTS):
+            segment = slice(rj * SEGMENT_SIZE, (rj + 1) * SEGMENT_SIZE)
+            aug_data[rows, :, :, segment] = timg[rand_idx[:, rj], :, :, segment]
+        aug_label[rows] = cls4aug
+
+    aug_shuffle = torch.randperm(aug_data.shape[0], device=timg.device)
+    return aug_data[aug_shuffle], aug_label[aug_shuffle]
+
+
+def interaug(timg: Any, label: Any, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    This method applies segmentation and reconstruction augmentation, where each augmented trial is stitched together
+    from 8 segments of 125 samples taken from randomly chosen trials of the same class. If timg is a torch tensor the
+    augmentation is generated on its device (cache it there once per epoch), otherwise a compiled Numba kernel is
+    used when numba is installed, falling back to vectorized NumPy. The Numba kernel draws from Numba's own random
+    state, so np.random.seed does not make the augmentation reproducible when numba is installed.
+    :param timg: The trials to augment, of shape (num_trials, 1, 22, 1125), as a NumPy array or a float32 tensor.
+    :param label: The class labels of the trials, of the same type as timg.
+    :param batch_size: The number of augmented trials to generate, split equally among the 4 classes.
+    :return: The augmented trials and their labels.
+    """
+    if isinstance(label, torch.Tensor):
+        class_counts = torch.bincount(label, minlength=4).tolist()
+    else:
+        class_counts = np.bincount(label, minlength=4)
+    missing_classes = [cls4aug for cls4aug in range(4) if class_counts[cls4aug] == 0]
+    if missing_classes:
+        raise ValueError(f'interaug needs trials of every class, but found none of class(es) {missing_classes}')
+
+    if isinstance(timg, torch.Tensor):
+        return _interaug_torch(timg.float(), label.to(timg.device), batch_size)
+
+    aug_size = batch_size // 4
+    aug_data = np.zeros((4 * aug_size, 1, 22, 1125), dtype=np.float32)
+    aug_label = np.empty(4 * aug_size, dtype=label.dtype)
+    _interaug_core(timg, label, aug_data, aug_label, 4 * aug_size)
+
     aug_shuffle = np.random.permutation(len(aug_data))
     aug_data = aug_data[aug_shuffle, :, :]
     aug_label = aug_label[aug_shuffle]
 
     aug_data = torch.from_numpy(aug_data)
-    aug_data = aug_data.float()
     aug_label = torch.from_numpy(aug_label).to(device)
     aug_label = aug_label.long()
-    return aug_data, aug_label
\ No newline at end of file
+    return aug_data, aug_label